@@ -1,18 +1,27 @@
 from __future__ import annotations
 
 import asyncio
+import heapq
 import logging
+import math
 import random
-from datetime import timedelta
-from typing import TYPE_CHECKING, List, Optional
+import time
+from datetime import datetime, timedelta
+from typing import TYPE_CHECKING, Dict, List, NamedTuple, Optional, Tuple
 
 import discord
 from discord import app_commands
-from discord.ext import commands, tasks
-from django.db import transaction
+from discord.ext import commands
+from django.db import IntegrityError, connection, transaction
+from django.db.models import F, OuterRef, Subquery
 from django.utils import timezone
 from asgiref.sync import sync_to_async
 
+try:
+    import numpy as np
+except ImportError:  # numpy is optional, large catalogs just use the pure-python sampler
+    np = None
+
 from bd_models.models import BallInstance, Player
 from settings.models import settings
 
@@ -23,148 +32,234 @@ if TYPE_CHECKING:
 log = logging.getLogger(__name__)
 Interaction = discord.Interaction["BallsDexBot"]
 
+# pg advisory lock key serializing rotation creation across every bot process
+MERCHANT_LOCK_KEY = 0x4D45524348414E54
+# seconds a loaded MerchantSettings row is reused before being read again
+SETTINGS_TTL = 30
+# item pool size from which rotations are sampled with numpy, when installed
+NUMPY_SAMPLE_THRESHOLD = 256
+
+
+class RotationCache(NamedTuple):
+    ends_at: datetime
+    entries: Dict[int, MerchantRotationItem]
+    choices: Dict[int, Tuple[str, app_commands.Choice[int]]]
+    embed: discord.Embed
+
+
 class Merchant(commands.GroupCog, name="merchant"):
     """Traveling merchant system (BallsDex v3 compatible)."""
 
     def __init__(self, bot: "BallsDexBot"):
         self.bot = bot
         self._rotation_lock = asyncio.Lock()
-        self._rotation_refresher.start()
-
-    async def cog_unload(self) -> None:
-        self._rotation_refresher.cancel()
-
-    @tasks.loop(minutes=5)
-    async def _rotation_refresher(self) -> None:
-        await self.ensure_rotation()
+        self._rot_cache: Optional[RotationCache] = None
+        self._settings_cache: Optional[Tuple[MerchantSettings, float]] = None
+        # monotonic deadline before which a missing rotation is not looked up again
+        self._no_rotation_until = 0.0
+        # dedicated generators for rotation sampling, seedable for reproducible rotations
+        self._rng = random.Random()
+        self._np_rng = np.random.default_rng() if np is not None else None
+
+    async def cog_load(self) -> None:
+        # prewarm the rotation cache so the first command after startup is served from memory
+        try:
+            await self._cached_rotation()
+        except Exception:
+            log.exception("Failed to prewarm the merchant rotation cache.")
+
+    async def _load_settings(self) -> MerchantSettings:
+        cached = self._settings_cache
+        if cached and time.monotonic() - cached[1] < SETTINGS_TTL:
+            return cached[0]
 
-    @_rotation_refresher.before_loop
-    async def _before_rotation_loop(self) -> None:
-        await self.bot.wait_until_ready()
+        config = await MerchantSettings.load()
+        self._settings_cache = (config, time.monotonic())
+        return config
 
     async def ensure_rotation(self) -> Optional[MerchantRotation]:
         async with self._rotation_lock:
-            config = await MerchantSettings.load()
+            config, rotation = await asyncio.gather(self._load_settings(), self._get_active_rotation())
             if not config.enabled:
                 return None
 
             now = timezone.now()
-            rotation = await self._get_active_rotation()
             if rotation and rotation.ends_at > now:
                 return rotation
 
-            return await self._create_rotation(config)
+            return await sync_to_async(self._create_rotation)(config)
 
     async def _get_active_rotation(self) -> Optional[MerchantRotation]:
         return await MerchantRotation.objects.filter(
             ends_at__gt=timezone.now()
         ).order_by("-starts_at").afirst()
 
-    async def _create_rotation(self, config: MerchantSettings) -> Optional[MerchantRotation]:
-        qs = (
-            MerchantItem.objects.filter(enabled=True)
-            .select_related("ball", "special")
-            .order_by("id")
-        )
-        items = [item async for item in qs]
-        if not items:
-            log.warning("Merchant rotation skipped: no enabled items found in database.")
-            return None
+    def _create_rotation(self, config: MerchantSettings) -> Optional[MerchantRotation]:
+        self._rot_cache = None
+        with transaction.atomic():
+            # blocks until any other process creating a rotation has committed
+            with connection.cursor() as cursor:
+                cursor.execute("SELECT pg_advisory_xact_lock(%s)", [MERCHANT_LOCK_KEY])
 
-        count = min(config.items_per_rotation, len(items))
-        selection = self._weighted_sample(items, count)
+            now = timezone.now()
+            # the process that held the lock before us may have committed a rotation
+            rotation = MerchantRotation.objects.filter(ends_at__gt=now).order_by("-starts_at").first()
+            if rotation:
+                return rotation
 
-        now = timezone.now()
-        rotation = await MerchantRotation.objects.acreate(
-            starts_at=now,
-            ends_at=now + timedelta(minutes=config.rotation_minutes),
-        )
+            # sampling only needs weights and prices, offers reference the item by pk
+            qs = (
+                MerchantItem.objects.filter(enabled=True)
+                .only("id", "weight", "price")
+                .order_by("id")
+            )
+            items = list(qs)
+            if not items:
+                log.warning("Merchant rotation skipped: no enabled items found in database.")
+                return None
 
-        await MerchantRotationItem.objects.abulk_create(
-            [
-                MerchantRotationItem(
-                    rotation=rotation,
-                    item=item,
-                    price_snapshot=item.price,
-                )
-                for item in selection
-            ]
-        )
+            count = min(config.items_per_rotation, len(items))
+            selection = self._weighted_sample(items, count)
 
-        await MerchantSettings.objects.filter(pk=config.pk).aupdate(
-            last_rotation_at=now
-        )
+            rotation = MerchantRotation.objects.create(
+                starts_at=now,
+                ends_at=now + timedelta(minutes=config.rotation_minutes),
+            )
+
+            MerchantRotationItem.objects.bulk_create(
+                (
+                    MerchantRotationItem(
+                        rotation=rotation,
+                        item_id=item.pk,
+                        price_snapshot=item.price,
+                    )
+                    for item in selection
+                ),
+                batch_size=100,
+            )
+
+            MerchantSettings.objects.filter(pk=config.pk).update(
+                last_rotation_at=now
+            )
 
         log.info("Merchant rotation created with %s items.", len(selection))
         return rotation
 
-    @staticmethod
-    def _weighted_sample(items: List[MerchantItem], k: int) -> List[MerchantItem]:
-        pool = list(items)
-        chosen: List[MerchantItem] = []
-        while pool and len(chosen) < k:
-            weights = [max(1, i.weight) for i in pool]
-            pick = random.choices(pool, weights=weights, k=1)[0]
-            chosen.append(pick)
-            pool.remove(pick)
-        return chosen
-
-    async def _get_rotation_items(self, rotation: MerchantRotation) -> List[MerchantRotationItem]:
-        qs = rotation.rotation_items.select_related("item__ball", "item__special")
-        return [entry async for entry in qs]
+    def _weighted_sample(self, items: List[MerchantItem], k: int) -> List[MerchantItem]:
+        # Efraimidis-Spirakis A-Res: key each item by log(u) / w and keep the k largest.
+        # Log-space keys avoid u ** (1 / w) underflowing to 0 for large weights.
+        if self._np_rng is not None and 0 < k and len(items) >= NUMPY_SAMPLE_THRESHOLD:
+            n = len(items)
+            weights = np.fromiter((max(1, item.weight) for item in items), dtype=np.float64, count=n)
+            np_keys = np.log1p(-self._np_rng.random(n)) / weights
+            return [items[i] for i in np.argpartition(-np_keys, k - 1)[:k]]
+
+        keys = [(math.log(1.0 - self._rng.random()) / max(1, item.weight), item) for item in items]
+        return [item for _, item in heapq.nlargest(k, keys, key=lambda pair: pair[0])]
+
+    async def _get_rotation_items(self, rotation: MerchantRotation) -> Dict[int, MerchantRotationItem]:
+        # every relation dereferenced by view/buy must be listed here, lazy loads would
+        # run synchronously inside the purchase transaction. ball and special stay whole
+        # since BallInstance.description() reads them, and rotation is kept because the
+        # related manager reads rotation_id on every row.
+        qs = rotation.rotation_items.select_related("item", "item__ball", "item__special").only(
+            "id", "price_snapshot", "rotation", "item__id", "item__display_name", "item__ball", "item__special"
+        )
+        return {entry.id: entry async for entry in qs}
 
-    @app_commands.command(name="view", description="View the current merchant rotation.")
-    async def view(self, interaction: Interaction) -> None:
-        rotation = await self.ensure_rotation()
+    async def _cached_rotation(self, create: bool = True) -> Optional[RotationCache]:
+        config = await self._load_settings()
+        if not config.enabled:
+            return None
+
+        cache = self._rot_cache
+        if cache and cache.ends_at > timezone.now():
+            return cache
+        if time.monotonic() < self._no_rotation_until:
+            return None
+
+        if create:
+            rotation = await self.ensure_rotation()
+        else:
+            rotation = await self._get_active_rotation()
         if not rotation:
-            await interaction.response.send_message("The merchant is currently unavailable.", ephemeral=True)
-            return
+            self._rot_cache = None
+            if create:
+                # nothing could be created (empty item pool), don't retry on every command
+                self._no_rotation_until = time.monotonic() + SETTINGS_TTL
+            return None
 
         entries = await self._get_rotation_items(rotation)
+        choices = {
+            e.id: (e.item.label.lower(), app_commands.Choice(name=f"{e.item.label} ({e.price_snapshot})", value=e.id))
+            for e in entries.values()
+        }
         currency = settings.currency_name or "coins"
+        display_lines = []
+        for entry in entries.values():
+            special = f" ({entry.item.special.name})" if entry.item.special else ""
+            display_lines.append(
+                f"`{entry.id}` — **{entry.item.label}**{special}\n└ Price: {entry.price_snapshot} {currency}"
+            )
 
-        embed = discord.Embed(
-            title="🧳 Traveling Merchant",
-            description=f"Offers refresh {discord.utils.format_dt(rotation.ends_at, style='R')}.",
-            colour=discord.Colour.gold(),
-        )
-
-        if not entries:
+        # static part of /merchant view, copied per command with the refresh time filled in
+        embed = discord.Embed(title="🧳 Traveling Merchant", colour=discord.Colour.gold())
+        if not display_lines:
             embed.description = "The merchant has nothing to sell right now."
         else:
-            lines = []
-            for entry in entries:
-                special = f" ({entry.item.special.name})" if entry.item.special else ""
-                lines.append(f"`{entry.id}` — **{entry.item.label}**{special}\n└ Price: {entry.price_snapshot} {currency}")
-            embed.add_field(name="Current Stock", value="\n".join(lines), inline=False)
+            embed.add_field(name="Current Stock", value="\n".join(display_lines), inline=False)
+
+        self._rot_cache = RotationCache(rotation.ends_at, entries, choices, embed)
+        return self._rot_cache
+
+    @app_commands.command(name="view", description="View the current merchant rotation.")
+    async def view(self, interaction: Interaction) -> None:
+        cache = await self._cached_rotation()
+        if not cache:
+            await interaction.response.send_message("The merchant is currently unavailable.", ephemeral=True)
+            return
+
+        embed = cache.embed.copy()
+        if embed.fields:
+            embed.description = f"Offers refresh {discord.utils.format_dt(cache.ends_at, style='R')}."
 
         await interaction.response.send_message(embed=embed, ephemeral=True)
 
     @app_commands.command(name="buy", description="Buy an item from the merchant.")
-    async def buy(self, interaction: Interaction, item_id: int) -> None:
-        config = await MerchantSettings.load()
+    async def buy(self, interaction: Interaction, item_id: app_commands.Range[int, 1]) -> None:
+        config = await self._load_settings()
         if not config.enabled:
             await interaction.response.send_message("The merchant is currently closed.", ephemeral=True)
             return
 
-        rotation = await self.ensure_rotation()
-        if not rotation:
+        cache = await self._cached_rotation()
+        if not cache:
             await interaction.response.send_message("No active rotation.", ephemeral=True)
             return
 
-        entries = await self._get_rotation_items(rotation)
-        entry = next((e for e in entries if e.id == item_id), None)
+        entry = cache.entries.get(item_id)
         if not entry:
             await interaction.response.send_message("Invalid item ID. Check `/merchant view`.", ephemeral=True)
             return
 
-        player, _ = await Player.objects.aget_or_create(discord_id=interaction.user.id)
+        # correlated subquery rather than Max(): an index seek on (player, -created_at)
+        # instead of aggregating the player's whole purchase history
+        last_purchase_qs = MerchantPurchase.objects.filter(player=OuterRef("pk")).order_by("-created_at")
+        players = Player.objects.filter(discord_id=interaction.user.id).annotate(
+            last_purchase=Subquery(last_purchase_qs.values("created_at")[:1])
+        )
+        player = await players.afirst()
+        if player is None:
+            try:
+                player = await Player.objects.acreate(discord_id=interaction.user.id)
+            except IntegrityError:
+                # the player was registered by a concurrent command
+                player = await players.aget()
+        last_purchase = getattr(player, "last_purchase", None)
 
-        last_purchase = await MerchantPurchase.objects.filter(player=player).order_by("-created_at").afirst()
         if last_purchase:
-            cooldown = timedelta(seconds=config.purchase_cooldown_seconds)
-            if timezone.now() < last_purchase.created_at + cooldown:
-                ready_at = last_purchase.created_at + cooldown
+            ready_at = last_purchase + config.purchase_cooldown
+            if timezone.now() < ready_at:
                 await interaction.response.send_message(
                     f"You're on cooldown! You can buy again {discord.utils.format_dt(ready_at, 'R')}.",
                     ephemeral=True
@@ -179,26 +274,33 @@ class Merchant(commands.GroupCog, name="merchant"):
 
         def process_purchase():
             with transaction.atomic():
-                p = Player.objects.select_for_update().get(pk=player.pk)
-                if not p.can_afford(entry.price_snapshot):
+                # funds are re-checked by the WHERE clause, a lost race simply matches no rows
+                charged = Player.objects.filter(pk=player.pk, money__gte=entry.price_snapshot).update(
+                    money=F("money") - entry.price_snapshot
+                )
+                if not charged:
                     return None, "Insufficient funds."
-                
-                p.money -= entry.price_snapshot
-                p.save()
 
                 inst = BallInstance.objects.create(
                     ball=entry.item.ball,
-                    player=p,
+                    player=player,
                     special=entry.item.special,
                     server_id=interaction.guild_id,
                     tradeable=True,
                     attack_bonus=random.randint(-settings.max_attack_bonus, settings.max_attack_bonus),
                     health_bonus=random.randint(-settings.max_health_bonus, settings.max_health_bonus),
                 )
-                MerchantPurchase.objects.create(player=p, rotation_item=entry)
+                MerchantPurchase.objects.create(player=player, rotation_item=entry)
                 return inst, None
 
-        instance, error = await sync_to_async(process_purchase)()
+        try:
+            instance, error = await sync_to_async(process_purchase)()
+        except IntegrityError:
+            # the offer was deleted from the admin panel after the rotation got cached; the
+            # deferred foreign key check fails at COMMIT and the whole purchase is rolled back
+            self._rot_cache = None
+            await interaction.followup.send("Invalid item ID. Check `/merchant view`.", ephemeral=True)
+            return
 
         if error:
             await interaction.followup.send(error, ephemeral=True)
@@ -210,10 +312,27 @@ class Merchant(commands.GroupCog, name="merchant"):
 
     @buy.autocomplete("item_id")
     async def autocomplete_item(self, interaction: Interaction, current: str):
-        rotation = await self._get_active_rotation()
-        if not rotation: return []
-        entries = await self._get_rotation_items(rotation)
-        return [
-            app_commands.Choice(name=f"{e.item.label} ({e.price_snapshot})", value=e.id)
-            for e in entries if current.lower() in e.item.label.lower()
-        ][:25]
+        # fires on every keystroke, so never create a rotation from here
+        cache = await self._cached_rotation(create=False)
+        if not cache: return []
+        if current.isdecimal():
+            match = cache.choices.get(int(current))
+            if match:
+                return [match[1]]
+            result = []
+            for entry_id, (_, choice) in cache.choices.items():
+                if str(entry_id).startswith(current):
+                    result.append(choice)
+                    if len(result) == 25:
+                        break
+            if result:
+                return result
+
+        current = current.lower()
+        result = []
+        for label, choice in cache.choices.values():
+            if current in label:
+                result.append(choice)
+                if len(result) == 25:
+                    break
+        return result
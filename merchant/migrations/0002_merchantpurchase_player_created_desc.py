@@ -0,0 +1,18 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("merchant", "0001_initial"),
+    ]
+
+    operations = [
+        migrations.RemoveIndex(
+            model_name="merchantpurchase",
+            name="merchant_me_player__8ef229_idx",
+        ),
+        migrations.AddIndex(
+            model_name="merchantpurchase",
+            index=models.Index(fields=["player", "-created_at"], name="mp_player_created_desc"),
+        ),
+    ]
@@ -125,7 +125,8 @@ class MerchantPurchase(models.Model):
 
     class Meta:
         ordering = ("-created_at",)
-        indexes = (models.Index(fields=("player", "created_at")),)
+        # serves the cooldown lookup in /merchant buy (latest purchase of a player)
+        indexes = (models.Index(fields=("player", "-created_at"), name="mp_player_created_desc"),)
 
     def __str__(self) -> str:
         return f"{self.player_id} -> {self.rotation_item_id}"